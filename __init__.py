@@ -302,7 +302,7 @@ class KFXOutput(OutputFormatPlugin):
             print(result.guidance)
             log.info("**************************************************************")
 
-        if result.logs and include_logs:
+        if include_logs and result.logs:
             log.info("\n************** Kindle Previewer Conversion Logs **************")
             print(result.logs)
             log.info("*************************************************************")
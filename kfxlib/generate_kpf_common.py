@@ -5,26 +5,22 @@ from __future__ import (unicode_literals, division, absolute_import, print_funct
 
 import base64
 import collections
+import functools
 import io
 import os
-import platform
 import re
 import shutil
+import stat
 import subprocess
+import threading
 import time
 
-try:
-    import psutil
-except ImportError:
-    psutil = None
-
 from calibre.utils.config_base import tweaks
 
-from .message_logging import log
+from .message_logging import (get_current_logger, log, set_logger)
 from .original_source_epub import SourceEpub
 from .utilities import (
-        create_temp_dir, file_read_binary, file_read_utf8, file_write_binary,
-        natural_sort_key, quote_name, truncate_list, windows_user_dir, winepath, wine_userreg,
+        create_temp_dir, natural_sort_key, quote_name, truncate_list, windows_user_dir, winepath, wine_userreg,
         IS_LINUX, IS_MACOS, IS_WINDOWS, LOCALE_ENCODING)
 
 if IS_WINDOWS:
@@ -40,41 +36,56 @@ __copyright__ = "2016-2024, John Howell <jhowell@acm.org>"
 PREPARE_EPUBS_FOR_PREVIEWER = True
 FORCED_CLEANED_FILENAME = None
 STOP_ONCE_INPUT_PREPARED = False
+FIXED_COMPLETION_SLEEP = False
 LOG_CONVERSION_DURATION_SEC = 60
 MAX_GUIDANCE = 100
 
 
 CONVERSION_SLEEP_SEC = 0.1
 COMPLETION_SLEEP_SEC = 1.0
+OUTPUT_SETTLE_SLEEP_SEC = 0.05
 UNKNOWN_VERSION_PREFIX = "unknown"
 EXECUTABLE_EXT = ".exe" if IS_WINDOWS or IS_LINUX else ""
+BASE64_CHARS = frozenset(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=")
+MIN_BASE64_ARG_LEN = 8
+UNSAFE_FILENAME_CHARS_RE = re.compile(r"[^a-zA-Z0-9 :/\\_+-]")
+STARTS_ALPHA_RE = re.compile(r"^[a-zA-Z]")
+USERREG_DEFAULT_VALUE_RE = re.compile(r'@="([^"]*)"')
+USERREG_PREVIEWER_KEY = "\n[Software\\\\Amazon\\\\Kindle Previewer 3]"
 
 
 class ConversionApplication(object):
     def __init__(self):
         self.program_path = self.locate_program()
-        if not os.path.isdir(self.program_path):
-            raise Exception("%s not installed as expected. (%s missing)" % (self.PROGRAM_NAME, self.program_path))
-
         self.main_program_path = os.path.join(self.program_path, self.PROGRAM_NAME + EXECUTABLE_EXT)
         self.program_version = self.get_program_version()
+
+        if self.program_version == UNKNOWN_VERSION_PREFIX and not os.path.isdir(self.program_path):
+            raise Exception("%s not installed as expected. (%s missing)" % (self.PROGRAM_NAME, self.program_path))
+
         self.program_version_sort = natural_sort_key(self.program_version)
 
         if not self.program_version.startswith(UNKNOWN_VERSION_PREFIX):
-            if self.MIN_SUPPORTED_VERSION and self.program_version_sort < natural_sort_key(self.MIN_SUPPORTED_VERSION):
+            if self.MIN_SUPPORTED_VERSION and self.program_version_sort < self.MIN_SUPPORTED_VERSION_SORT:
                 raise Exception("Unsupported %s version %s is installed (version %s or newer required)" % (
                         self.PROGRAM_NAME, self.program_version, self.MIN_SUPPORTED_VERSION))
 
-            if self.MIN_DESIRED_VERSION and self.program_version_sort < natural_sort_key(self.MIN_DESIRED_VERSION):
+            if self.MIN_DESIRED_VERSION and self.program_version_sort < self.MIN_DESIRED_VERSION_SORT:
                 log.warning("%s version %s is installed. Updating to a more recent version is recommended for better conversion results" % (
                         self.PROGRAM_NAME, self.program_version))
 
     def get_program_version(self):
-        if not os.path.isfile(self.main_program_path):
+        try:
+            program_stat = os.stat(self.main_program_path)
+        except OSError:
             return UNKNOWN_VERSION_PREFIX
 
-        program_len = os.path.getsize(self.main_program_path)
-        return self.PROGRAM_VERSIONS.get(program_len, "%s_%d" % (UNKNOWN_VERSION_PREFIX, program_len))
+        if not stat.S_ISREG(program_stat.st_mode):
+            return UNKNOWN_VERSION_PREFIX
+
+        program_len = program_stat.st_size
+        program_version = self.PROGRAM_VERSIONS.get(program_len)
+        return program_version if program_version is not None else "%s_%d" % (UNKNOWN_VERSION_PREFIX, program_len)
 
 
 class KindlePreviewer(ConversionApplication):
@@ -286,7 +297,10 @@ class KindlePreviewer(ConversionApplication):
             }
 
     if not MIN_DESIRED_VERSION:
-        MIN_DESIRED_VERSION = sorted(list(PROGRAM_VERSIONS.values()), key=natural_sort_key)[-1]
+        MIN_DESIRED_VERSION = max(PROGRAM_VERSIONS.values(), key=natural_sort_key)
+
+    MIN_SUPPORTED_VERSION_SORT = natural_sort_key(MIN_SUPPORTED_VERSION) if MIN_SUPPORTED_VERSION else None
+    MIN_DESIRED_VERSION_SORT = natural_sort_key(MIN_DESIRED_VERSION) if MIN_DESIRED_VERSION else None
 
     def locate_program(self):
         program_path = tweaks.get("kfx_output_previewer_path")
@@ -315,16 +329,21 @@ class KindlePreviewer(ConversionApplication):
         if IS_LINUX:
             userreg = wine_userreg()
 
-            with io.open(userreg, "r") as file:
-                for line in file:
-                    if line.startswith("[Software\\\\Amazon\\\\Kindle Previewer 3]"):
-                        for line in file:
-                            match = re.search("@=\"([^\"]*)\"", line)
-                            if match:
-                                return winepath(match.group(1))
+            with io.open(userreg, "r", encoding="utf-8", errors="replace") as file:
+                data = file.read()
 
-                            if line.startswith("["):
-                                break
+            key_start = data.find(USERREG_PREVIEWER_KEY)
+            if key_start >= 0:
+                key_start += len(USERREG_PREVIEWER_KEY)
+                key_end = data.find("\n[", key_start)
+                if key_end < 0:
+                    key_end = len(data)
+
+                for line in data[key_start:key_end].split("\n"):
+                    if "@=\"" in line:
+                        match = USERREG_DEFAULT_VALUE_RE.search(line)
+                        if match:
+                            return winepath(match.group(1))
 
             raise Exception("Kindle Previewer 3 not found in %s." % userreg)
 
@@ -344,7 +363,8 @@ class ConversionProcess(object):
         self.log_output = log_output
         self.application = sequence.application
         self.timeout_sec = sequence.timeout_sec
-        self.out_file = self.output = self.error_msg = self.returncode = self.process_failure = None
+        self.out_file = self.error_msg = self.returncode = self.process_failure = None
+        self.env = None
         self.log_data = collections.OrderedDict()
 
     def run(self):
@@ -355,8 +375,10 @@ class ConversionProcess(object):
     def start(self):
         log.info("Launching %s (%s) - %s" % (
             self.application.PROGRAM_NAME, self.application.program_version, self.function_name))
-        self.out_file = open(self.out_file_name, "wb")
-        self.log_data["%s environment" % self.function_name] = self.execution_environment_log()
+        self.out_file = open(self.out_file_name, "w+b")
+        self.log_data["%s environment" % self.function_name] = functools.partial(
+                execution_environment_log, self.application.program_path, self.working_dir, list(self.argv),
+                dict(os.environ if self.env is None else self.env), self.env is None)
 
         if self.use_wincon and WindowsConsole is not None:
             self.wincon = WindowsConsole()
@@ -379,44 +401,51 @@ class ConversionProcess(object):
         pass
 
     def wait_for_completion(self):
-        start_time = time.time()
-        timeout = False
+        start_time = time.monotonic()
+        self.timed_out = False
 
-        while self.process.poll() is None:
-            if self.wincon is not None:
-                self.wincon.restore_original_console_buffer_on_change()
+        if self.timeout_sec:
+            timeout_timer = threading.Timer(self.timeout_sec, self.timeout_expired, args=(get_current_logger(),))
+            timeout_timer.daemon = True
+            timeout_timer.start()
+        else:
+            timeout_timer = None
 
-            if self.timeout_sec and (time.time() - start_time > self.timeout_sec) and not timeout:
-                log.warning("Killing process")
-                timeout = True
+        if self.wincon is not None:
+            self.wincon_done = threading.Event()
+            self.wincon_error = None
+            self.wincon_thread = threading.Thread(target=self.monitor_wincon, args=(get_current_logger(),), daemon=True)
+            self.wincon_thread.start()
 
-                try:
-                    if psutil is not None:
-                        parent = psutil.Process(self.process.pid)
-                        children = parent.children(recursive=True)
-                        for child in children:
-                            child.kill()
-                        psutil.wait_procs(children, timeout=5)
-                        parent.kill()
-                    else:
-                        self.process.kill()
-                except Exception as e:
-                    self.error("Failed to kill conversion process: %s" % repr(e))
+        try:
+            self.process.wait()
+        finally:
+            if timeout_timer is not None:
+                timeout_timer.cancel()
+                timeout_timer.join()
+
+            if self.wincon is not None:
+                self.wincon_done.set()
+                self.wincon_thread.join()
 
-            time.sleep(CONVERSION_SLEEP_SEC)
+        if self.wincon is not None and self.wincon_error is not None:
+            raise self.wincon_error
 
-        duration = time.time() - start_time
+        duration = time.monotonic() - start_time
         if duration > LOG_CONVERSION_DURATION_SEC:
             log.info("Conversion process took %d seconds" % duration)
 
-        time.sleep(COMPLETION_SLEEP_SEC)
+        if FIXED_COMPLETION_SLEEP:
+            time.sleep(COMPLETION_SLEEP_SEC)
+        else:
+            self.wait_for_output_to_settle()
 
         if self.wincon is not None:
             self.wincon.restore_original_console_buffer()
             self.write_out_file(self.wincon.get_alternate_console_data())
             self.wincon.free_alternate_console_buffer()
 
-        if timeout:
+        if self.timed_out:
             self.returncode = -1
             self.error("Process Terminated: %s did not complete within %d seconds" % (self.function_name, self.timeout_sec))
         else:
@@ -426,13 +455,70 @@ class ConversionProcess(object):
             else:
                 self.process_failure = False
 
-        self.out_file.close()
-        self.output = file_read_utf8(self.out_file_name).rstrip()
+        self.out_file.seek(0)
 
-        if self.log_output:
-            log.info(self.output)
-        else:
-            self.log_data[os.path.basename(self.out_file_name)] = self.output
+        with io.TextIOWrapper(self.out_file, encoding="utf8", errors="replace", newline="\n") as output:
+            if self.log_output:
+                blank_lines = 0
+                for line in output:
+                    line = line.replace("\r", "").rstrip()
+                    if line:
+                        for i in range(blank_lines):
+                            log.info("")
+
+                        blank_lines = 0
+                        log.info(line)
+                    else:
+                        blank_lines += 1
+            else:
+                self.log_data[os.path.basename(self.out_file_name)] = output.read().replace("\r", "").rstrip()
+
+    def monitor_wincon(self, logger):
+        set_logger(logger)
+
+        try:
+            while not self.wincon_done.wait(CONVERSION_SLEEP_SEC):
+                self.wincon.restore_original_console_buffer_on_change()
+        except Exception as e:
+            log.error("Failed to monitor the console buffer: %s" % repr(e))
+            self.wincon_error = e
+
+    def timeout_expired(self, logger):
+        set_logger(logger)
+        log.warning("Killing process")
+        self.timed_out = True
+
+        try:
+            self.kill_process()
+        except Exception as e:
+            self.error("Failed to kill conversion process: %s" % repr(e))
+
+    def kill_process(self):
+        try:
+            import psutil
+        except ImportError:
+            self.process.kill()
+            return
+
+        parent = psutil.Process(self.process.pid)
+        children = parent.children(recursive=True)
+        for child in children:
+            child.kill()
+        psutil.wait_procs(children, timeout=5)
+        parent.kill()
+
+    def wait_for_output_to_settle(self):
+        out_fd = self.out_file.fileno()
+        out_size = os.fstat(out_fd).st_size
+        deadline = time.monotonic() + COMPLETION_SLEEP_SEC
+
+        while time.monotonic() < deadline:
+            time.sleep(OUTPUT_SETTLE_SLEEP_SEC)
+            new_out_size = os.fstat(out_fd).st_size
+            if new_out_size == out_size:
+                break
+
+            out_size = new_out_size
 
     def close_out_file(self):
         if self.out_file is not None:
@@ -455,36 +541,6 @@ class ConversionProcess(object):
             if val is not None:
                 self.env[env_var] = val
 
-    def execution_environment_log(self):
-        exe_env = []
-        exe_env.append("platform: %s, architecture: %s, locale: %s" % (
-                platform.platform(), platform.architecture(), LOCALE_ENCODING))
-        exe_env.append("program_path: %s" % self.application.program_path)
-        exe_env.append("cwd: %s" % self.working_dir)
-
-        exe_env.append("argv:")
-        for arg in self.argv:
-            if re.match(r"^[A-Za-z0-9+/=]+$", arg):
-                try:
-                    arg_decoded = base64.b64decode(arg).decode("ascii")
-                except Exception:
-                    pass
-                else:
-                    arg = "%s (base64) --> %s" % (arg, arg_decoded)
-
-            exe_env.append("  %s" % arg)
-
-        if self.env is not None:
-            exe_env.append("environment:")
-            for k, v in sorted(self.env.items()):
-                exe_env.append("  %s = %s" % (k, v))
-        else:
-            exe_env.append("default environment:")
-            for k, v in sorted(os.environ.items()):
-                exe_env.append("  %s = %s" % (k, v))
-
-        return "\n".join(exe_env)
-
 
 class ConversionSequence(object):
 
@@ -520,9 +576,9 @@ class ConversionSequence(object):
 
     def prepare_epub(self):
         root, ext = os.path.splitext(os.path.basename(self.infile))
-        simple_in_file_name = re.sub(r"[^a-zA-Z0-9 :/\\_+-]", "", root)
+        simple_in_file_name = UNSAFE_FILENAME_CHARS_RE.sub("", root)
 
-        if not re.match(r"^[a-zA-Z]", simple_in_file_name):
+        if not STARTS_ALPHA_RE.match(simple_in_file_name):
             simple_in_file_name = "f" + simple_in_file_name
 
         self.in_file_name = os.path.join(self.data_dir, simple_in_file_name + ext)
@@ -533,7 +589,7 @@ class ConversionSequence(object):
             source_epub.prepare_for_previewer(self.in_file_name, self.application, self.SEQUENCE_NAME)
 
             if self.cleaned_filename:
-                file_write_binary(self.cleaned_filename, file_read_binary(self.in_file_name))
+                shutil.copyfile(self.in_file_name, self.cleaned_filename)
                 log.info("Saved cleaned conversion input file to %s" % self.cleaned_filename)
         else:
             shutil.copyfile(self.infile, self.in_file_name)
@@ -563,22 +619,62 @@ class ConversionResult(object):
         self.kpf_data = kpf_data
         self.epub_data = epub_data
         self.error_msg = error_msg
-        self.logs = self.combine_logs(log_data, error_msg or success_msg)
+        self.log_data = log_data
+        self.log_msg = error_msg or success_msg
 
         if kpf_data is not None and error_msg:
             guidance_msgs = guidance_msgs + [error_msg]
 
         self.guidance = "\n".join(truncate_list(guidance_msgs, MAX_GUIDANCE))
 
+    @property
+    def logs(self):
+        if not hasattr(self, "_cached_logs"):
+            self._cached_logs = self.combine_logs(self.log_data, self.log_msg)
+
+        return self._cached_logs
+
     def combine_logs(self, log_data, msg):
-        log_lst = []
-        log_lst.append(msg)
-        log_lst.append("")
+        logs = io.StringIO()
+        logs.write(msg)
+        logs.write("\n")
+
+        for fn, lg in log_data.items():
+            if callable(lg):
+                lg = lg()
 
-        for fn in log_data.keys():
             sep = "=" * max((78 - len(fn)) // 2, 4)
-            log_lst.append("%s %s %s\n" % (sep, fn, sep))
-            log_lst.append(log_data[fn].rstrip())
-            log_lst.append("")
+            logs.write("\n%s %s %s\n\n" % (sep, fn, sep))
+            logs.write(lg.rstrip())
+            logs.write("\n")
+
+        return logs.getvalue()
+
+
+def execution_environment_log(program_path, working_dir, argv, env, default_env):
+    import platform
+
+    exe_env = []
+    exe_env.append("platform: %s, architecture: %s, locale: %s" % (
+            platform.platform(), platform.architecture(), LOCALE_ENCODING))
+    exe_env.append("program_path: %s" % program_path)
+    exe_env.append("cwd: %s" % working_dir)
+
+    exe_env.append("argv:")
+    for arg in argv:
+        if (len(arg) >= MIN_BASE64_ARG_LEN and len(arg) % 4 == 0 and arg.isascii() and
+                BASE64_CHARS.issuperset(arg.encode("ascii"))):
+            try:
+                arg_decoded = base64.b64decode(arg, validate=True).decode("ascii")
+            except ValueError:
+                pass
+            else:
+                arg = "%s (base64) --> %s" % (arg, arg_decoded)
+
+        exe_env.append("  %s" % arg)
+
+    exe_env.append("default environment:" if default_env else "environment:")
+    for k, v in sorted(env.items()):
+        exe_env.append("  %s = %s" % (k, v))
 
-        return "\n".join(log_lst)
+    return "\n".join(exe_env)
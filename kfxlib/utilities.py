@@ -130,6 +130,7 @@ def type_name(x):
     return type(x).__name__
 
 
+@functools.lru_cache(maxsize=4096)
 def natural_sort_key(s):
     return "".join(["00000000"[len(c):] + c if c.isdigit() else c for c in re.split(r"([0-9]+)", s.lower())])
 